@@ -1,42 +1,369 @@
-from pydantic_settings import BaseSettings, SettingsConfigDict
+import hashlib
+import json
+import logging
+import os
+import sys
+from dataclasses import asdict, dataclass, field, fields
+from functools import lru_cache
+from typing import TYPE_CHECKING, Annotated, Callable
 
+logger = logging.getLogger(__name__)
 
-class Settings(BaseSettings):
+
+def _bounded(default, ge, le=None):
+    # Range constraints live in the field metadata: checked once when
+    # Settings is built, and turned into pydantic Field() bounds in strict mode.
+    limits = {"ge": ge} if le is None else {"ge": ge, "le": le}
+    return field(default=default, metadata=limits)
+
+
+# Accepted EMBEDDING_DTYPE values; each but "auto" names a torch dtype.
+_EMBEDDING_DTYPES = ("auto", "float32", "float16", "bfloat16")
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
     QDRANT_HOST: str = "qdrant"
-    QDRANT_PORT: int = 6333
+    QDRANT_PORT: int = _bounded(6333, ge=1, le=65535)
+    QDRANT_GRPC_PORT: int = _bounded(6334, ge=1, le=65535)
+    # Talk to Qdrant over gRPC instead of REST; cheaper per request, which
+    # matters for batched searches.
+    QDRANT_PREFER_GRPC: bool = True
     QDRANT_API_KEY: str | None = None
     QDRANT_DISTANCE_METRIC: str = "Cosine"
     QDRANT_COLLECTION_V1_PREFIX: str = "doc_v1_"
     QDRANT_COLLECTION_V2_PREFIX: str = "doc_v2_"
+    # "int8" keeps a scalar-quantized copy of each collection in RAM for
+    # search, "binary" a 1-bit one (32x smaller; best with 1024+ dims);
+    # "none" searches the original vectors directly.
+    QDRANT_QUANTIZATION: str = "int8"
+    # With quantization on, this many times `limit` candidates are fetched
+    # from the quantized index and rescored with the original vectors.
+    QDRANT_OVERSAMPLING: float = _bounded(2.0, ge=1.0)
+    # Storage type of the original vectors ("float16" halves their footprint;
+    # "float32" keeps full precision). With quantization on they also live on
+    # disk, since searches only read them to rescore candidates.
+    QDRANT_VECTOR_DATATYPE: str = "float16"
 
     VLLM_HOST: str = "vllm"
-    VLLM_PORT: int = 8000
+    VLLM_PORT: int = _bounded(8000, ge=1, le=65535)
     VLLM_MODEL: str = "Qwen/Qwen2.5-7B-Instruct"
     VLLM_API_KEY: str = "secret"
 
     EMBEDDING_MODEL_NAME: str = "sergeyzh/BERTA"
-    EMBEDDING_DIM: int = 768
+    EMBEDDING_DIM: int = _bounded(768, ge=1)
+    # sentence-transformers backend: "onnx" runs the model through ONNX
+    # Runtime (falling back to "torch" if that cannot be loaded).
+    EMBEDDING_BACKEND: str = "onnx"
+    # ONNX file inside the model repo, e.g. "onnx/model_O3.onnx" for an
+    # optimized export; None uses the default export.
+    EMBEDDING_ONNX_FILE: str | None = None
+    # Weights dtype for the torch backend: "auto" is float16 on CUDA and
+    # float32 on CPU; "bfloat16" suits CPUs with AMX/AVX512-BF16.
+    EMBEDDING_DTYPE: str = "auto"
+    # Device for the embedding model ("cuda", "cuda:1", "cpu"); None lets
+    # sentence-transformers pick the first GPU if there is one.
+    EMBEDDING_DEVICE: str | None = None
+    # Intra-op threads for torch; 0 uses every core.
+    TORCH_NUM_THREADS: int = _bounded(0, ge=0)
+    # On-disk embedding cache; empty disables it.
+    EMBEDDING_CACHE_DIR: str = "embedding_cache"
     DEFAULT_DOC_PREFIX: str = "search_document: "
     DEFAULT_COMMENT_PREFIX: str = "search_query: "
+    # Texts per forward pass; raise on GPUs with spare memory.
+    EMBEDDING_BATCH_SIZE: int = _bounded(64, ge=1)
+
+    CHUNK_SIZE: int = _bounded(1000, ge=1)
+    CHUNK_OVERLAP: int = _bounded(200, ge=0)
+
+    LLM_MAX_CONCURRENCY: int = _bounded(32, ge=1)
+    # Cosine similarity above which a near-duplicate comment that retrieved
+    # the same chunks reuses an earlier verdict.
+    SEMANTIC_CACHE_THRESHOLD: float = _bounded(0.95, ge=0.0, le=1.0)
+    SEMANTIC_CACHE_TTL_SECONDS: int = _bounded(3600, ge=1)
+    # Entries are shared by tasks on the same documents until they expire.
+    # "memory" keeps a flat in-process index; "qdrant" stores entries in an
+    # HNSW-indexed collection shared by every worker, for caches too large to
+    # scan linearly.
+    SEMANTIC_CACHE_BACKEND: str = "memory"
+    QDRANT_SEMANTIC_CACHE_COLLECTION: str = "semantic_cache"
+
+    # "memory" keeps task state in the API process; "redis" shares it
+    # between uvicorn workers.
+    TASK_STORE_BACKEND: str = "memory"
+    REDIS_URL: str = "redis://redis:6379/0"
+
+    def __post_init__(self):
+        for f in _FIELDS:
+            value = getattr(self, f.name)
+            if isinstance(value, str):
+                # Prefixes, model names and hosts end up as prompt text,
+                # collection names and dict keys; intern them once so all
+                # call sites share a single str object and equality checks
+                # short-circuit on identity.
+                object.__setattr__(self, f.name, sys.intern(value))
+            elif f.metadata:
+                low, high = f.metadata["ge"], f.metadata.get("le")
+                if value < low or (high is not None and value > high):
+                    bounds = f">= {low}" if high is None else f"in [{low}, {high}]"
+                    raise ValueError(f"{f.name} must be {bounds}, got {value}")
+        if self.EMBEDDING_DTYPE not in _EMBEDDING_DTYPES:
+            raise ValueError(
+                f"EMBEDDING_DTYPE must be one of {', '.join(_EMBEDDING_DTYPES)}, "
+                f"got {self.EMBEDDING_DTYPE!r}"
+            )
+        # The text splitter rejects this too, but only once DocumentProcessor
+        # is built; fail while the configuration is loaded instead.
+        if self.CHUNK_OVERLAP >= self.CHUNK_SIZE:
+            raise ValueError(
+                f"CHUNK_OVERLAP must be less than CHUNK_SIZE "
+                f"({self.CHUNK_SIZE}), got {self.CHUNK_OVERLAP}"
+            )
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        overrides = _read_env()
+        for name in _CASTS.keys() & overrides.keys():
+            cast = _CASTS[name]
+            try:
+                overrides[name] = cast(overrides[name])
+            except ValueError:
+                raise ValueError(
+                    f"{name} must be {_TYPE_NAMES[cast]}, got {overrides[name]!r}"
+                ) from None
+        return cls(**overrides)
+
+
+# Field specs resolved once, so building Settings never re-inspects the class.
+_FIELDS = fields(Settings)
+
+
+def _to_bool(value: str) -> bool:
+    # Anything else is rejected rather than read as False, so a typo cannot
+    # silently flip a flag.
+    value = value.strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(value)
+
+
+_CASTS = {
+    f.name: _to_bool if f.type is bool else f.type
+    for f in _FIELDS
+    if f.type in (int, float, bool)
+}
+_TYPE_NAMES = {int: "an integer", float: "a number", _to_bool: "a boolean"}
+
+
+def _read_env() -> dict:
+    # Same lookup rules as pydantic-settings: field names are matched
+    # case-insensitively and unknown variables are ignored.
+    environ = {key.upper(): value for key, value in os.environ.items()}
+    return {f.name: environ[f.name] for f in _FIELDS if f.name in environ}
+
+
+def _load_strict() -> Settings:
+    # Opt-in full pydantic validation (CONFIG_STRICT=1). The environment has
+    # already been read by _read_env(), so a plain BaseModel is enough and
+    # pydantic is only imported here.
+    from pydantic import BaseModel, ConfigDict, Field, create_model
+
+    class _StrictBase(BaseModel):
+        model_config = ConfigDict(extra="ignore", frozen=True)
+
+    strict_cls = create_model(
+        "StrictSettings",
+        __base__=_StrictBase,
+        **{
+            f.name: (
+                Annotated[f.type, Field(**f.metadata)] if f.metadata else f.type,
+                f.default,
+            )
+            for f in _FIELDS
+        },
+    )
+    return Settings(**strict_cls(**_read_env()).model_dump())
+
+
+_SETTINGS_BLOB_ENV = "APP_SETTINGS_BLOB"
+
+
+def _env_digest() -> str:
+    # Fingerprint of every variable that feeds Settings, so a settings blob is
+    # only trusted by a process whose environment would resolve the same way.
+    raw = _read_env()
+    raw["CONFIG_STRICT"] = os.environ.get("CONFIG_STRICT")
+    return hashlib.sha1(json.dumps(raw, sort_keys=True).encode()).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    # Worker processes (uvicorn workers, multiprocessing children) inherit the
+    # parent's resolved settings instead of parsing and validating again, as
+    # long as their environment is the one the blob was resolved from.
+    digest = _env_digest()
+    blob = json.loads(os.environ.get(_SETTINGS_BLOB_ENV) or "{}")
+    if blob.get("env") == digest:
+        settings = Settings(**blob["settings"])
+    else:
+        if os.environ.get("CONFIG_STRICT") == "1":
+            settings = _load_strict()
+        else:
+            settings = Settings.from_env()
+        os.environ[_SETTINGS_BLOB_ENV] = json.dumps(
+            {"env": digest, "settings": asdict(settings)}
+        )
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Configuration loaded:\n%s", _banner(settings))
+
+    return settings
+
+
+def reset_settings():
+    # Forget the resolved settings (e.g. after changing the environment in
+    # tests): the next access re-reads the environment and re-derives every
+    # module constant.
+    get_settings.cache_clear()
+    os.environ.pop(_SETTINGS_BLOB_ENV, None)
+    for name in (*Settings.__dataclass_fields__, *_DERIVED):
+        globals().pop(name, None)
+
+
+def _banner(settings: Settings) -> str:
+    return "\n".join(
+        f"{label}: {value}"
+        for label, value in (
+            ("Qdrant Host", settings.QDRANT_HOST),
+            ("Qdrant Port", settings.QDRANT_PORT),
+            ("vLLM Host", settings.VLLM_HOST),
+            ("vLLM Port", settings.VLLM_PORT),
+            ("vLLM Model", settings.VLLM_MODEL),
+            ("Embedding Model", settings.EMBEDDING_MODEL_NAME),
+            ("Embedding Dim", settings.EMBEDDING_DIM),
+            ("Default Doc Prefix", repr(settings.DEFAULT_DOC_PREFIX)),
+            ("Default Comment Prefix", repr(settings.DEFAULT_COMMENT_PREFIX)),
+        )
+    )
+
+
+def _build_url(host: str, port: int, suffix: str = "") -> str:
+    return f"http://{host}:{port}{suffix}"
+
+
+def _resolve_distance(metric: str):
+    # Imported here so that loading the config does not pull in qdrant_client.
+    from qdrant_client.http.models import Distance
+
+    return Distance(metric)
+
+
+if TYPE_CHECKING:
+    # Static view of the lazily resolved module constants below, so that
+    # `from app.config import QDRANT_HOST` type-checks like a plain global.
+    from qdrant_client.http.models import Distance
+
+    settings: Settings
+
+    QDRANT_HOST: str
+    QDRANT_PORT: int
+    QDRANT_GRPC_PORT: int
+    QDRANT_PREFER_GRPC: bool
+    QDRANT_API_KEY: str | None
+    QDRANT_DISTANCE_METRIC: str
+    QDRANT_COLLECTION_V1_PREFIX: str
+    QDRANT_COLLECTION_V2_PREFIX: str
+    QDRANT_QUANTIZATION: str
+    QDRANT_OVERSAMPLING: float
+    QDRANT_VECTOR_DATATYPE: str
+
+    VLLM_HOST: str
+    VLLM_PORT: int
+    VLLM_MODEL: str
+    VLLM_API_KEY: str
+
+    EMBEDDING_MODEL_NAME: str
+    EMBEDDING_DIM: int
+    EMBEDDING_BACKEND: str
+    EMBEDDING_ONNX_FILE: str | None
+    EMBEDDING_DTYPE: str
+    EMBEDDING_DEVICE: str | None
+    TORCH_NUM_THREADS: int
+    EMBEDDING_CACHE_DIR: str
+    DEFAULT_DOC_PREFIX: str
+    DEFAULT_COMMENT_PREFIX: str
+    EMBEDDING_BATCH_SIZE: int
+
+    CHUNK_SIZE: int
+    CHUNK_OVERLAP: int
+
+    LLM_MAX_CONCURRENCY: int
+    SEMANTIC_CACHE_THRESHOLD: float
+    SEMANTIC_CACHE_TTL_SECONDS: int
+    SEMANTIC_CACHE_BACKEND: str
+    QDRANT_SEMANTIC_CACHE_COLLECTION: str
+
+    TASK_STORE_BACKEND: str
+    REDIS_URL: str
+
+    QDRANT_URL: str
+    VLLM_BASE_URL: str
+    V1_COLLECTION_TEMPLATE: Callable[[str], str]
+    V2_COLLECTION_TEMPLATE: Callable[[str], str]
+    QDRANT_DISTANCE: Distance
+    EMBEDDING_VECTOR_BYTES: int
+
+# Values derived from Settings, computed once on first access.
+_DERIVED = {
+    "QDRANT_URL": lambda s: _build_url(s.QDRANT_HOST, s.QDRANT_PORT),
+    "VLLM_BASE_URL": lambda s: _build_url(s.VLLM_HOST, s.VLLM_PORT, "/v1"),
+    # Bound str.format methods: V1_COLLECTION_TEMPLATE(base) -> "doc_v1_<base>".
+    "V1_COLLECTION_TEMPLATE": lambda s: (s.QDRANT_COLLECTION_V1_PREFIX + "{}").format,
+    "V2_COLLECTION_TEMPLATE": lambda s: (s.QDRANT_COLLECTION_V2_PREFIX + "{}").format,
+    # QDRANT_DISTANCE_METRIC ("Cosine", "Dot", ...) resolved to the enum member.
+    "QDRANT_DISTANCE": lambda s: _resolve_distance(s.QDRANT_DISTANCE_METRIC),
+    # Size of one float32 embedding, for payload-size estimates.
+    "EMBEDDING_VECTOR_BYTES": lambda s: s.EMBEDDING_DIM * 4,
+}
+
 
-    CHUNK_SIZE: int = 1000
-    CHUNK_OVERLAP: int = 200
+def __getattr__(name):
+    # Module-level lazy attributes (PEP 562): nothing below touches the
+    # environment until it is first accessed. Derived values are memoized
+    # into the module globals so later lookups skip this hook entirely.
+    if name == "settings":
+        return get_settings()
+    if name in Settings.__dataclass_fields__:
+        # Settings is frozen, so its fields can be hoisted to plain module
+        # constants: `from app.config import QDRANT_HOST`.
+        value = getattr(get_settings(), name)
+    elif name in _DERIVED:
+        value = _DERIVED[name](get_settings())
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
-    model_config = SettingsConfigDict(env_file=None, extra="ignore")
 
+__all__ = (
+    "Settings",
+    "get_settings",
+    "reset_settings",
+    "settings",
+    "QDRANT_URL",
+    "VLLM_BASE_URL",
+    "V1_COLLECTION_TEMPLATE",
+    "V2_COLLECTION_TEMPLATE",
+    "EMBEDDING_VECTOR_BYTES",
+)
 
-settings = Settings()
+# Only needed while the module body runs; keep the module namespace small.
+del dataclass, field, fields, lru_cache, TYPE_CHECKING, Callable
 
-QDRANT_URL = f"http://{settings.QDRANT_HOST}:{settings.QDRANT_PORT}"
-VLLM_BASE_URL = f"http://{settings.VLLM_HOST}:{settings.VLLM_PORT}/v1"
 
-print("--- Configuration Loaded ---")
-print(f"Qdrant Host: {settings.QDRANT_HOST}")
-print(f"Qdrant Port: {settings.QDRANT_PORT}")
-print(f"vLLM Host: {settings.VLLM_HOST}")
-print(f"vLLM Port: {settings.VLLM_PORT}")
-print(f"vLLM Model: {settings.VLLM_MODEL}")
-print(f"Embedding Model: {settings.EMBEDDING_MODEL_NAME}")
-print(f"Embedding Dim: {settings.EMBEDDING_DIM}")
-print(f"Default Doc Prefix: '{settings.DEFAULT_DOC_PREFIX}'")
-print(f"Default Comment Prefix: '{settings.DEFAULT_COMMENT_PREFIX}'")
+if __name__ == "__main__":
+    # `python -m app.config` prints the resolved configuration.
+    print("--- Configuration Loaded ---")
+    print(_banner(get_settings()))
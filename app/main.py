@@ -1,20 +1,25 @@
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
 import os
 import asyncio
+import hashlib
 import shutil
 import uuid
-import json
 import logging
+import orjson
+from collections import Counter
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 
 from app.services.document_processor import DocumentProcessor
 from app.services.vector_store import VectorStoreService
 from app.utils.llm_client import LLMClient
-from app.services.comment_analyzer import CommentAnalyzer
-from app.config import settings
+from app.services.comment_analyzer import CommentAnalyzer, cache_namespace
+from app.services.task_store import create_task_store
+from app import config
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,10 +28,38 @@ processor = DocumentProcessor()
 vector_store = VectorStoreService()
 llm_client = LLMClient()
 comment_analyzer = CommentAnalyzer(vector_store, llm_client)
+task_store = create_task_store()
+
+
+class StreamAwareGZipMiddleware(GZipMiddleware):
+    # Starlette's gzip writer buffers streamed bodies until enough data
+    # accumulates, which would hold back server-sent events.
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
-app = FastAPI(title="Document Analysis API")
 
-results_store: Dict[str, Dict] = {}
+app = FastAPI(title="Document Analysis API")
+app.add_middleware(StreamAwareGZipMiddleware, minimum_size=1000)
+
+templates = Jinja2Templates(
+    directory=os.path.join(os.path.dirname(__file__), "templates")
+)
+
+PROGRESS_STEPS = {
+    "uploading": {"text": "Загрузка документов", "percent": 10},
+    "processing_v1": {"text": "Обработка документа версии 1", "percent": 20},
+    "processing_v2": {"text": "Обработка документа версии 2", "percent": 40},
+    "processing_comments": {"text": "Обработка комментариев", "percent": 60},
+    "creating_vector_db": {"text": "Создание векторной базы данных", "percent": 70},
+    "analyzing_comments": {
+        "text": "Анализ комментариев с помощью ИИ",
+        "percent": 80,
+    },
+    "saving_results": {"text": "Сохранение результатов анализа", "percent": 95},
+}
 
 os.makedirs("uploads", exist_ok=True)
 os.makedirs("results", exist_ok=True)
@@ -34,9 +67,108 @@ os.makedirs("results", exist_ok=True)
 app.mount("/results", StaticFiles(directory="results"), name="results")
 
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    return """
+UPLOAD_COPY_CHUNK_SIZE = 1 << 20
+
+
+# Static parts of the progress page; only the status block between them is
+# rendered per request.
+_PROGRESS_PAGE_PREFIX = """
+        <html>
+        <head>
+            <title>Обработка документов</title>
+            <noscript><meta http-equiv="refresh" content="3"></noscript>
+            <style>
+                body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
+                h1 { color: #333; }
+                .processing { background-color: #fff3cd; padding: 15px; border-radius: 4px; }
+                .progress-container {
+                    margin: 20px 0;
+                    height: 24px;
+                    background-color: #f3f3f3;
+                    border-radius: 12px;
+                    overflow: hidden;
+                }
+                .progress-bar {
+                    height: 24px;
+                    background-color: #4CAF50;
+                    text-align: center;
+                    line-height: 24px;
+                    color: white;
+                    transition: width 0.5s;
+                }
+                .step-list { margin-top: 20px; }
+                .step { padding: 8px; margin: 5px 0; }
+                .step.active {
+                    background-color: #e7f3ff;
+                    border-left: 4px solid #0275d8;
+                    font-weight: bold;
+                }
+                .step.completed {
+                    background-color: #e8f5e9;
+                    border-left: 4px solid #4CAF50;
+                    color: #388e3c;
+                }
+            </style>
+        </head>
+        <body>
+            <h1>Обработка документов</h1>
+            <div class="processing">""".encode()
+_PROGRESS_PAGE_SUFFIX = """
+                <p style="margin-top: 20px;">Эта страница обновляется автоматически.</p>
+            </div>
+            <script>
+                var source = new EventSource(window.location.pathname.replace(/\\/html$/, "/stream"));
+                source.onmessage = function (event) {
+                    var state = JSON.parse(event.data);
+                    if (state.status !== "processing") {
+                        source.close();
+                        window.location.reload();
+                        return;
+                    }
+                    var bar = document.getElementById("progress-bar");
+                    bar.style.width = state.percent + "%";
+                    bar.textContent = state.percent + "%";
+                    document.getElementById("progress-text").textContent = state.text;
+                    document.getElementById("comment-progress").textContent = state.comment_progress;
+                    document.querySelectorAll(".step").forEach(function (step) {
+                        var done = state.percent > Number(step.dataset.threshold);
+                        step.classList.toggle("completed", done);
+                        step.classList.toggle("active", !done && step.dataset.step === state.progress);
+                    });
+                };
+            </script>
+        </body>
+        </html>
+""".encode()
+
+
+def describe_progress(result: Dict):
+    progress = result.get("progress", "unknown")
+    progress_text = "Processing documents"
+    progress_percent = 0
+
+    if progress in PROGRESS_STEPS:
+        progress_info = PROGRESS_STEPS[progress]
+        progress_text = progress_info["text"]
+        progress_percent = progress_info["percent"]
+
+    if progress == "analyzing_comments":
+        comment_progress = result.get("comment_progress", "")
+        if comment_progress:
+            progress_text += f" ({comment_progress})"
+
+    return progress_text, progress_percent
+
+
+def _save_upload(upload_file: UploadFile, file_path: str):
+    # Copy in fixed-size slices so memory stays flat regardless of file size.
+    upload_file.file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(upload_file.file, f, UPLOAD_COPY_CHUNK_SIZE)
+
+
+# The landing page is static, so it is encoded once instead of per request.
+_ROOT_HTML_BYTES = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -130,7 +262,12 @@ async def root():
         </form>
     </body>
     </html>
-    """
+""".encode()
+
+
+@app.get("/", response_class=HTMLResponse)
+async def root():
+    return Response(content=_ROOT_HTML_BYTES, media_type="text/html")
 
 
 @app.post("/analyze/")
@@ -155,9 +292,7 @@ async def analyze_documents(
         (comments_path, comments),
     ]:
         try:
-            with open(file_path, "wb") as f:
-                content = await upload_file.read()
-                f.write(content)
+            await asyncio.to_thread(_save_upload, upload_file, file_path)
         except Exception as e:
             shutil.rmtree(task_dir, ignore_errors=True)
             raise HTTPException(
@@ -166,17 +301,20 @@ async def analyze_documents(
             )
 
     doc_base_name = os.path.splitext(os.path.basename(doc_v1.filename))[0]
-    results_store[task_id] = {
-        "status": "processing",
-        "created_at": datetime.now().isoformat(),
-        "doc_v1": doc_v1.filename,
-        "doc_v2": doc_v2.filename,
-        "comments": comments.filename,
-        "base_name": doc_base_name,
-        "progress": "uploading",
-        "result": None,
-        "results_path": None,
-    }
+    await task_store.create(
+        task_id,
+        {
+            "status": "processing",
+            "created_at": datetime.now().isoformat(),
+            "doc_v1": doc_v1.filename,
+            "doc_v2": doc_v2.filename,
+            "comments": comments.filename,
+            "base_name": doc_base_name,
+            "progress": "uploading",
+            "result": None,
+            "results_path": None,
+        },
+    )
 
     background_tasks.add_task(
         process_documents,
@@ -244,10 +382,11 @@ async def analyze_documents(
 
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    if task_id not in results_store:
+    result = await task_store.get(task_id)
+    if result is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    result = results_store[task_id]
+    result = await load_result(result)
 
     if result["status"] == "completed" and result.get("results_path"):
         result["results_url"] = f"/results/{os.path.basename(result['results_path'])}"
@@ -255,9 +394,39 @@ async def get_status(task_id: str):
     return result
 
 
+@app.get("/status/{task_id}/stream")
+async def stream_status(task_id: str):
+    if await task_store.get(task_id) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def events():
+        # Without a change, the current state is re-sent every 15 seconds
+        # as a keep-alive.
+        async for result in task_store.watch(task_id, keepalive=15):
+            text, percent = describe_progress(result)
+            state = {
+                "status": result["status"],
+                "progress": result.get("progress"),
+                "comment_progress": result.get("comment_progress", ""),
+                "text": text,
+                "percent": percent,
+            }
+            yield f"data: {orjson.dumps(state).decode()}\n\n"
+
+            if result["status"] != "processing":
+                return
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 @app.get("/status/{task_id}/html", response_class=HTMLResponse)
-async def get_status_html(task_id: str):
-    if task_id not in results_store:
+async def get_status_html(task_id: str, request: Request):
+    result = await task_store.get(task_id)
+    if result is None:
         return HTMLResponse(
             """
             <html><body>
@@ -269,236 +438,78 @@ async def get_status_html(task_id: str):
             status_code=404,
         )
 
-    result = results_store[task_id]
-    status = result["status"]
+    if result["status"] == "completed":
+        # A finished report never changes, so let the browser revalidate
+        # against an ETag instead of re-rendering the whole page. Checked
+        # before load_result(), so a revalidation never reads the results file.
+        etag = f'W/"{task_id}-{result.get("completed_at", "")}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
 
-    progress_mapping = {
-        "uploading": {"text": "Загрузка документов", "percent": 10},
-        "processing_v1": {"text": "Обработка документа версии 1", "percent": 20},
-        "processing_v2": {"text": "Обработка документа версии 2", "percent": 40},
-        "processing_comments": {"text": "Обработка комментариев", "percent": 60},
-        "creating_vector_db": {"text": "Создание векторной базы данных", "percent": 70},
-        "analyzing_comments": {
-            "text": "Анализ комментариев с помощью ИИ",
-            "percent": 80,
-        },
-        "saving_results": {"text": "Сохранение результатов анализа", "percent": 95},
-    }
+    result = await load_result(result)
+    status = result["status"]
 
     if status == "processing":
         progress = result.get("progress", "unknown")
-        progress_text = "Processing documents"
-        progress_percent = 0
-
-        if progress in progress_mapping:
-            progress_info = progress_mapping[progress]
-            progress_text = progress_info["text"]
-            progress_percent = progress_info["percent"]
+        progress_text, progress_percent = describe_progress(result)
 
-        if progress == "analyzing_comments":
-            comment_progress = result.get("comment_progress", "")
-            if comment_progress:
-                progress_text += f" ({comment_progress})"
+        def step_class(step: str, threshold: int) -> str:
+            if progress_percent > threshold:
+                return "completed"
+            return "active" if progress == step else ""
 
-        html = f"""
-        <html>
-        <head>
-            <title>Обработка документов</title>
-            <meta http-equiv="refresh" content="3;url=/status/{task_id}/html?t={int(datetime.now().timestamp())}">
-            <style>
-                body {{ font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }}
-                h1 {{ color: #333; }}
-                .processing {{ background-color: #fff3cd; padding: 15px; border-radius: 4px; }}
-                .progress-container {{
-                    margin: 20px 0;
-                    height: 24px;
-                    background-color: #f3f3f3;
-                    border-radius: 12px;
-                    overflow: hidden;
-                }}
-                .progress-bar {{
-                    height: 24px;
-                    width: {progress_percent}%;
-                    background-color: #4CAF50;
-                    text-align: center;
-                    line-height: 24px;
-                    color: white;
-                    transition: width 0.5s;
-                }}
-                .step-list {{ margin-top: 20px; }}
-                .step {{ padding: 8px; margin: 5px 0; }}
-                .step.active {{
-                    background-color: #e7f3ff;
-                    border-left: 4px solid #0275d8;
-                    font-weight: bold;
-                }}
-                .step.completed {{
-                    background-color: #e8f5e9;
-                    border-left: 4px solid #4CAF50;
-                    color: #388e3c;
-                }}
-            </style>
-        </head>
-        <body>
-            <h1>Обработка документов</h1>
-            <div class="processing">
-                <p><strong>Текущий статус:</strong> {progress_text}</p>
+        body = f"""
+                <p><strong>Текущий статус:</strong> <span id="progress-text">{progress_text}</span></p>
                 <div class="progress-container">
-                    <div class="progress-bar">{progress_percent}%</div>
+                    <div class="progress-bar" id="progress-bar" style="width: {progress_percent}%;">{progress_percent}%</div>
                 </div>
                 <div class="step-list">
-                    <div class="step {'completed' if progress_percent > 10 else 'active' if progress == 'uploading' else ''}">
+                    <div class="step {step_class('uploading', 10)}" data-step="uploading" data-threshold="10">
                         Загрузка документов
                     </div>
-                    <div class="step {'completed' if progress_percent > 20 else 'active' if progress == 'processing_v1' else ''}">
+                    <div class="step {step_class('processing_v1', 20)}" data-step="processing_v1" data-threshold="20">
                         Обработка документа версии 1: {result['doc_v1']}
                     </div>
-                    <div class="step {'completed' if progress_percent > 40 else 'active' if progress == 'processing_v2' else ''}">
+                    <div class="step {step_class('processing_v2', 40)}" data-step="processing_v2" data-threshold="40">
                         Обработка документа версии 2: {result['doc_v2']}
                     </div>
-                    <div class="step {'completed' if progress_percent > 60 else 'active' if progress == 'processing_comments' else ''}">
+                    <div class="step {step_class('processing_comments', 60)}" data-step="processing_comments" data-threshold="60">
                         Обработка комментариев: {result['comments']}
                     </div>
-                    <div class="step {'completed' if progress_percent > 70 else 'active' if progress == 'creating_vector_db' else ''}">
+                    <div class="step {step_class('creating_vector_db', 70)}" data-step="creating_vector_db" data-threshold="70">
                         Создание векторной базы данных
                     </div>
-                    <div class="step {'completed' if progress_percent > 80 else 'active' if progress == 'analyzing_comments' else ''}">
-                        Анализ комментариев с помощью ИИ {result.get('comment_progress', '')}
+                    <div class="step {step_class('analyzing_comments', 80)}" data-step="analyzing_comments" data-threshold="80">
+                        Анализ комментариев с помощью ИИ <span id="comment-progress">{result.get('comment_progress', '')}</span>
                     </div>
-                    <div class="step {'completed' if progress_percent > 95 else 'active' if progress == 'saving_results' else ''}">
+                    <div class="step {step_class('saving_results', 95)}" data-step="saving_results" data-threshold="95">
                         Сохранение результатов анализа
                     </div>
-                </div>
-                <p style="margin-top: 20px;">Эта страница будет автоматически обновляться каждые 3 секунды.</p>
-            </div>
-        </body>
-        </html>
-        """
+                </div>"""
+        return Response(
+            content=_PROGRESS_PAGE_PREFIX + body.encode() + _PROGRESS_PAGE_SUFFIX,
+            media_type="text/html",
+        )
 
     elif status == "completed":
-        html = f"""
-        <html>
-        <head>
-            <title>Анализ завершён</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; max-width: 1000px; margin: 0 auto; padding: 20px; }}
-                h1, h2, h3 {{ color: #333; }}
-                .success {{ background-color: #d4edda; padding: 15px; border-radius: 4px; margin-bottom: 20px; }}
-                .comment-container {{ border: 1px solid #ddd; margin-bottom: 20px; border-radius: 8px; overflow: hidden; }}
-                .comment-header {{ background-color: #f8f8f8; padding: 10px 15px; border-bottom: 1px solid #ddd; display: flex; justify-content: space-between; align-items: center; }}
-                .comment-header h3 {{ margin: 0; }}
-                .comment-body {{ padding: 15px; }}
-                .comment-text {{ font-weight: bold; margin-bottom: 10px; }}
-                .status {{ padding: 5px 10px; border-radius: 4px; display: inline-block; margin: 5px 0; }}
-                .status-учтен {{ background-color: #d4edda; color: #155724; }}
-                .status-частично-учтен {{ background-color: #fff3cd; color: #856404; }}
-                .status-не-учтен {{ background-color: #f8d7da; color: #721c24; }}
-                .status-error {{ background-color: #f8d7da; color: #721c24; }}
-                .evidence {{ background-color: #f8f9fa; padding: 10px; margin: 10px 0; border-left: 4px solid #6c757d; white-space: pre-wrap; font-family: monospace; }}
-                .explanation {{ margin-bottom: 15px; white-space: pre-wrap; }}
-                .suggestion {{ background-color: #e2f0fb; padding: 10px; margin: 10px 0; border-left: 4px solid #0275d8; white-space: pre-wrap; }}
-                .btn {{ background-color: #4CAF50; color: white; padding: 10px 15px; text-decoration: none; border-radius: 4px; display: inline-block; margin-right: 10px; }}
-                .summary {{ margin-bottom: 25px; }}
-                .summary-stats {{ display: flex; gap: 20px; margin-top: 15px; flex-wrap: wrap; }}
-                .summary-stat {{ padding: 15px; border-radius: 8px; flex: 1; text-align: center; min-width: 150px; }}
-                .stat-addressed {{ background-color: #d4edda; }}
-                .stat-partially {{ background-color: #fff3cd; }}
-                .stat-not {{ background-color: #f8d7da; }}
-                .toggle-btn {{ background-color: #6c757d; color: white; padding: 5px 10px; cursor: pointer; border: none; border-radius: 4px; }}
-            </style>
-            <script>
-                function toggleDetails(commentId) {{
-                    var details = document.getElementById('details-' + commentId);
-                    var button = document.getElementById('btn-' + commentId);
-                    if (details.style.display === 'none' || details.style.display === '') {{
-                        details.style.display = 'block';
-                        button.textContent = 'Скрыть детали';
-                    }} else {{
-                        details.style.display = 'none';
-                        button.textContent = 'Показать детали';
-                    }}
-                }}
-            </script>
-        </head>
-        <body>
-            <h1>Результаты анализа документа</h1>
-            <div class="success">
-                <p>Анализ документа успешно завершен.</p>
-                <p><b>Документ V1:</b> {result.get('doc_v1', 'Н/Д')}</p>
-                <p><b>Документ V2:</b> {result.get('doc_v2', 'Н/Д')}</p>
-                <p><b>Комментарии:</b> {result.get('comments', 'Н/Д')}</p>
-                {'<a href="' + f"/results/{os.path.basename(result['results_path'])}" + '" class="btn" download>Скачать полный анализ (JSON)</a>' if result.get('results_path') else ''}
-                <a href="/" class="btn" style="background-color: #6c757d;">Вернуться на главную</a>
-            </div>
-            <div class="summary">
-                <h2>Сводка анализа</h2>
-        """
-
-        results_data = result.get("result", [])
-        total = len(results_data)
-        addressed = sum(1 for c in results_data if c.get("status") == "учтен")
-        partially = sum(1 for c in results_data if c.get("status") == "частично учтен")
-        not_addressed = sum(1 for c in results_data if c.get("status") == "не учтен")
-        error_count = sum(1 for c in results_data if c.get("status") == "error")
-
-        html += f"""
-                <div class="summary-stats">
-                    <div class="summary-stat stat-addressed">
-                        <h3>{addressed}</h3>
-                        <p>Учтены</p>
-                    </div>
-                    <div class="summary-stat stat-partially">
-                        <h3>{partially}</h3>
-                        <p>Частично учтены</p>
-                    </div>
-                    <div class="summary-stat stat-not">
-                        <h3>{not_addressed}</h3>
-                        <p>Не учтены</p>
-                    </div>
-                    {f'<div class="summary-stat status-error"><h3>{error_count}</h3><p>Ошибка</p></div>' if error_count > 0 else ''}
-                </div>
-            </div>
-
-            <h2>Детальный анализ ({total} комментариев)</h2>
-        """
-
-        for i, comment in enumerate(results_data):
-            comment_id = comment.get("comment_id", i + 1)
-            comment_text = comment.get("comment_text", "Н/Д")
-            status = comment.get("status", "error")
-            explanation = comment.get("explanation", "No explanation available.")
-            evidence_v1 = comment.get("evidence_v1", "No evidence found in V1.")
-            evidence_v2 = comment.get("evidence_v2", "No evidence found in V2.")
-            suggestion = comment.get("suggestion", "")
-
-            status_class = f"status-{status.replace(' ', '-')}"
-
-            html += f"""
-            <div class="comment-container">
-                <div class="comment-header">
-                    <h3>Комментарий {comment_id}</h3>
-                    <button id="btn-{i}" onclick="toggleDetails('{i}')" class="toggle-btn">Показать детали</button>
-                </div>
-                <div class="comment-body">
-                    <div class="comment-text">{comment_text}</div>
-                    <div class="status {status_class}">{status}</div>
-                    <div id="details-{i}" style="display: none;">
-                        <h4>Объяснение:</h4>
-                        <div class="explanation">{explanation}</div>
-                        <h4>Подтверждение из V1:</h4>
-                        <div class="evidence">{evidence_v1}</div>
-                        <h4>Подтверждение из V2:</h4>
-                        <div class="evidence">{evidence_v2}</div>
-                        {f'<h4>Предложение:</h4><div class="suggestion">{suggestion}</div>' if suggestion else ''}
-                    </div>
-                </div>
-            </div>
-            """
-
-        html += """
-        </body>
-        </html>
-        """
+        results_data = result.get("result") or []
+        counts = Counter(c.get("status") for c in results_data)
+        results_url = (
+            f"/results/{os.path.basename(result['results_path'])}"
+            if result.get("results_path")
+            else None
+        )
+        return templates.TemplateResponse(
+            request,
+            "status_completed.html",
+            {
+                "result": result,
+                "comments": results_data,
+                "counts": counts,
+                "results_url": results_url,
+            },
+            headers={"ETag": etag},
+        )
     else:
         error_message = result.get("error", "Unknown error occurred")
         html = f"""
@@ -528,6 +539,60 @@ async def get_status_html(task_id: str):
     return HTMLResponse(content=html, status_code=200)
 
 
+def read_results(results_path: str):
+    with open(results_path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+async def load_result(result: Dict) -> Dict:
+    if (
+        result["status"] == "completed"
+        and result.get("result") is None
+        and result.get("results_path")
+    ):
+        try:
+            result["result"] = await asyncio.to_thread(
+                read_results, result["results_path"]
+            )
+        except Exception as e:
+            logger.warning(f"Failed to load result file {result['results_path']}: {e}")
+            # Reported for this request only: the stored record may be the
+            # task store's live dict, and the next read should retry.
+            return {
+                **result,
+                "status": "error",
+                "error": f"Failed to load results: {e}",
+            }
+    return result
+
+
+def write_results(results_path: str, results):
+    # orjson writes UTF-8 without escaping, same as ensure_ascii=False. The
+    # file is read back by code, so it is stored compact rather than indented.
+    with open(results_path, "wb") as f:
+        f.write(orjson.dumps(results))
+
+
+def _dedupe_comments(comments: List[Dict]):
+    # Comments with identical text are analyzed once; slots[i] is the index
+    # of comment i's first occurrence in the returned unique list.
+    unique = []
+    first_seen: Dict[bytes, int] = {}
+    slots = []
+    for comment in comments:
+        key = hashlib.blake2b(comment["comment_text"].encode(), digest_size=16).digest()
+        if key not in first_seen:
+            first_seen[key] = len(unique)
+            unique.append(comment)
+        slots.append(first_seen[key])
+    return unique, slots
+
+
+def _ingest(collection_name: str, chunks):
+    vector_store.recreate_collection(collection_name)
+    vector_store.upsert_chunks(collection_name, chunks)
+
+
 async def process_documents(
     task_id: str,
     doc_v1_path: str,
@@ -538,102 +603,119 @@ async def process_documents(
     try:
         logger.info(f"Starting processing for task {task_id}")
 
-        results_store[task_id]["progress"] = "processing_v1"
+        await task_store.update(task_id, progress="processing_v1")
         await asyncio.sleep(0)
 
-        processed_v1 = processor.process_document(doc_v1_path)
+        loop = asyncio.get_running_loop()
+
+        def report_step(step: str):
+            # Called from process_pair's worker thread; waits for the update,
+            # so it cannot land after a later step set from here.
+            asyncio.run_coroutine_threadsafe(
+                task_store.update(task_id, progress=step), loop
+            ).result()
+
+        # Both versions are split in parallel, then they and the comments are
+        # embedded in one pass over the model, which the comments step covers.
+        processed_v1, processed_v2, processed_comments = await asyncio.to_thread(
+            processor.process_pair,
+            doc_v1_path,
+            doc_v2_path,
+            comments_path,
+            report_step,
+        )
         if not processed_v1 or not processed_v1.get("chunks"):
             raise Exception(
                 f"Failed to process document v1 or no text extracted: {doc_v1_path}"
             )
-
-        results_store[task_id]["progress"] = "processing_v2"
-        await asyncio.sleep(0)
-
-        processed_v2 = processor.process_document(doc_v2_path)
         if not processed_v2 or not processed_v2.get("chunks"):
             raise Exception(
                 f"Failed to process document v2 or no text extracted: {doc_v2_path}"
             )
-
-        results_store[task_id]["progress"] = "processing_comments"
-        await asyncio.sleep(0)
-
-        processed_comments = processor.process_comments(comments_path)
         if not processed_comments:
             raise Exception(
                 f"Failed to process comments or no comments found: {comments_path}"
             )
 
-        results_store[task_id]["progress"] = "creating_vector_db"
+        await task_store.update(task_id, progress="creating_vector_db")
         await asyncio.sleep(0)
 
         clean_base_name = doc_base_name
         for prefix in [
-            settings.QDRANT_COLLECTION_V1_PREFIX,
-            settings.QDRANT_COLLECTION_V2_PREFIX,
+            config.QDRANT_COLLECTION_V1_PREFIX,
+            config.QDRANT_COLLECTION_V2_PREFIX,
         ]:
             if clean_base_name.startswith(prefix):
                 clean_base_name = clean_base_name[len(prefix) :]
 
-        v1_collection = (
-            f"{settings.QDRANT_COLLECTION_V1_PREFIX}{clean_base_name}-{task_id}"
-        )
-        v2_collection = (
-            f"{settings.QDRANT_COLLECTION_V2_PREFIX}{clean_base_name}-{task_id}"
-        )
-
-        vector_store.recreate_collection(v1_collection)
-        vector_store.upsert_chunks(v1_collection, processed_v1["chunks"])
+        analysis_base_name = f"{clean_base_name}-{task_id}"
+        v1_collection = config.V1_COLLECTION_TEMPLATE(analysis_base_name)
+        v2_collection = config.V2_COLLECTION_TEMPLATE(analysis_base_name)
 
-        vector_store.recreate_collection(v2_collection)
-        vector_store.upsert_chunks(v2_collection, processed_v2["chunks"])
+        await asyncio.gather(
+            asyncio.to_thread(_ingest, v1_collection, processed_v1["chunks"]),
+            asyncio.to_thread(_ingest, v2_collection, processed_v2["chunks"]),
+        )
 
-        results_store[task_id]["progress"] = "analyzing_comments"
+        await task_store.update(task_id, progress="analyzing_comments")
         await asyncio.sleep(0)
 
-        results = []
-        total_comments = len(processed_comments)
+        unique_comments, slots = _dedupe_comments(processed_comments)
+        if len(unique_comments) < len(processed_comments):
+            logger.info(
+                f"Task {task_id}: {len(processed_comments) - len(unique_comments)} "
+                f"duplicate comments will reuse earlier results"
+            )
 
-        analysis_base_name = f"{clean_base_name}-{task_id}"
+        total_comments = len(unique_comments)
+        await task_store.update(task_id, comment_progress=f"0/{total_comments}")
+        logger.info(f"Task {task_id}: Analyzing {total_comments} comments")
 
-        for i, comment in enumerate(processed_comments):
-            results_store[task_id]["comment_progress"] = f"{i+1}/{total_comments}"
-            await asyncio.sleep(0)
+        async def report_progress(done: int):
+            await task_store.update(
+                task_id, comment_progress=f"{done}/{total_comments}"
+            )
 
-            logger.info(f"Task {task_id}: Analyzing comment {i+1}/{total_comments}")
+        try:
+            analyzed = await comment_analyzer.analyze_all(
+                unique_comments,
+                analysis_base_name,
+                cache_namespace(processed_v1["chunks"], processed_v2["chunks"]),
+                on_progress=report_progress,
+            )
+        finally:
+            comment_analyzer.forget(analysis_base_name)
 
-            result = comment_analyzer.analyze_comment(comment, analysis_base_name)
-            results.append(result)
+        results = [
+            {**analyzed[slot], "comment_id": comment["comment_id"]}
+            for comment, slot in zip(processed_comments, slots)
+        ]
 
-        results_store[task_id]["progress"] = "saving_results"
+        await task_store.update(task_id, progress="saving_results")
         await asyncio.sleep(0)
 
         results_file = f"results_{task_id}.json"
         results_path = os.path.join("results", results_file)
 
-        with open(results_path, "w", encoding="utf-8") as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
+        await asyncio.to_thread(write_results, results_path, results)
 
-        results_store[task_id].update(
-            {
-                "status": "completed",
-                "progress": "completed",
-                "completed_at": datetime.now().isoformat(),
-                "result": results,
-                "results_path": results_path,
-            }
+        await task_store.update(
+            task_id,
+            status="completed",
+            progress="completed",
+            completed_at=datetime.now().isoformat(),
+            result=results,
+            results_path=results_path,
         )
 
     except Exception as e:
         logger.error(f"Error processing task {task_id}: {e}", exc_info=True)
-        results_store[task_id].update(
-            {
-                "status": "error",
-                "progress": "error",
-                "error": str(e),
-                "completed_at": datetime.now().isoformat(),
-            }
+        await task_store.update(
+            task_id,
+            status="error",
+            progress="error",
+            error=str(e),
+            completed_at=datetime.now().isoformat(),
         )
 
 
@@ -641,8 +723,8 @@ async def process_documents(
 async def startup_event():
     logger.info("Starting Document Analysis API")
 
-    logger.info(f"vLLM URL: http://{settings.VLLM_HOST}:{settings.VLLM_PORT}/v1")
-    logger.info(f"Qdrant URL: http://{settings.QDRANT_HOST}:{settings.QDRANT_PORT}")
+    logger.info(f"vLLM URL: {config.VLLM_BASE_URL}")
+    logger.info(f"Qdrant URL: {config.QDRANT_URL}")
 
     for directory in ["results", "uploads"]:
         os.makedirs(directory, exist_ok=True)
@@ -651,58 +733,69 @@ async def startup_event():
         except Exception as e:
             logger.warning(f"Failed to set permissions on {directory}: {e}")
 
-    results_dir = "results"
-    loaded_count = 0
+    loaded = await asyncio.to_thread(load_existing_results)
+    for task_id, state in loaded.items():
+        await task_store.create(task_id, state)
+    logger.info(f"Loaded {len(loaded)} existing results from disk")
 
-    if os.path.exists(results_dir):
-        for filename in os.listdir(results_dir):
-            if filename.startswith("results_") and filename.endswith(".json"):
-                try:
-                    task_id = filename[8:-5]
-                    filepath = os.path.join(results_dir, filename)
-
-                    with open(filepath, "r", encoding="utf-8") as f:
-                        results_data = json.load(f)
-
-                    results_store[task_id] = {
-                        "status": "completed",
-                        "progress": "completed",
-                        "created_at": datetime.fromtimestamp(
-                            os.path.getctime(filepath)
-                        ).isoformat(),
-                        "completed_at": datetime.fromtimestamp(
-                            os.path.getmtime(filepath)
-                        ).isoformat(),
-                        "result": results_data,
-                        "results_path": filepath,
-                    }
-                    loaded_count += 1
-
-                except Exception as e:
-                    logger.warning(f"Failed to load result file {filename}: {e}")
-
-    logger.info(f"Loaded {loaded_count} existing results from disk")
+    removed = await asyncio.to_thread(cleanup_old_files, days=7)
+    for task_id in removed:
+        await task_store.delete(task_id)
 
-    cleanup_old_files(days=7)
 
+def load_existing_results() -> Dict[str, Dict]:
+    results_dir = "results"
+    loaded = {}
 
-def cleanup_old_files(days=7):
-    now = datetime.now()
+    if os.path.exists(results_dir):
+        # One directory pass; DirEntry.stat() reuses the entry's cached stat.
+        with os.scandir(results_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith("results_") and name.endswith(".json"):
+                    try:
+                        st = entry.stat()
+                        # Only index the file here; its contents are parsed on
+                        # the first status request that needs them (see
+                        # load_result).
+                        loaded[name[8:-5]] = {
+                            "status": "completed",
+                            "progress": "completed",
+                            "created_at": datetime.fromtimestamp(
+                                st.st_ctime
+                            ).isoformat(),
+                            "completed_at": datetime.fromtimestamp(
+                                st.st_mtime
+                            ).isoformat(),
+                            "result": None,
+                            "results_path": entry.path,
+                        }
+
+                    except Exception as e:
+                        logger.warning(f"Failed to load result file {name}: {e}")
+
+    return loaded
+
+
+def cleanup_old_files(days=7) -> List[str]:
+    # Same rule as before: files more than `days` whole days old are removed.
+    cutoff = datetime.now().timestamp() - (days + 1) * 86400
     results_dir = "results"
+    removed = []
 
     if os.path.exists(results_dir):
-        for filename in os.listdir(results_dir):
-            if filename.startswith("results_") and filename.endswith(".json"):
-                filepath = os.path.join(results_dir, filename)
-                try:
-                    mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
-                    if (now - mtime).days > days:
-                        task_id = filename[8:-5]
-                        os.remove(filepath)
-                        if task_id in results_store:
-                            del results_store[task_id]
-                        logger.info(f"Cleaned up old result file: {filename}")
-                except Exception as e:
-                    logger.warning(
-                        f"Failed to process file during cleanup: {filepath}, {e}"
-                    )
+        with os.scandir(results_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith("results_") and name.endswith(".json"):
+                    try:
+                        if entry.stat().st_mtime <= cutoff:
+                            os.remove(entry.path)
+                            removed.append(name[8:-5])
+                            logger.info(f"Cleaned up old result file: {name}")
+                    except Exception as e:
+                        logger.warning(
+                            f"Failed to process file during cleanup: {entry.path}, {e}"
+                        )
+
+    return removed
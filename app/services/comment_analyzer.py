@@ -1,51 +1,24 @@
-import json
+import asyncio
+import hashlib
 import logging
-from typing import Dict, Optional
-from ..config import settings
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-
-class CommentAnalyzer:
-    def __init__(self, vector_store, llm_client, top_k=10):
-        self.vector_store = vector_store
-        self.llm_client = llm_client
-        self.top_k = top_k
-
-    def analyze_comment(self, comment: Dict, doc_base_name: str) -> Dict:
-        v1_collection = f"{settings.QDRANT_COLLECTION_V1_PREFIX}{doc_base_name}"
-        v2_collection = f"{settings.QDRANT_COLLECTION_V2_PREFIX}{doc_base_name}"
-
-        logger.info(
-            f"Analyzing comment {comment['comment_id']}: '{comment['comment_text'][:50]}...'"
-        )
+import numpy as np
+import orjson
 
-        v1_results = self.vector_store.search(
-            v1_collection, comment["embedding"], self.top_k
-        )
-        v2_results = self.vector_store.search(
-            v2_collection, comment["embedding"], self.top_k
-        )
+from .. import config
+from .semantic_cache import CACHED_FIELDS, create_semantic_cache, normalize
 
-        v1_text = "\n\n".join(
-            [f"Chunk {i+1}:\n{hit.payload['text']}" for i, hit in enumerate(v1_results)]
-        )
-        v2_text = "\n\n".join(
-            [f"Chunk {i+1}:\n{hit.payload['text']}" for i, hit in enumerate(v2_results)]
-        )
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-        prompt = f"""
-You are an expert document analyst. Determine if a comment made on an earlier document version was addressed in a newer version.
+# Everything that does not depend on the comment goes in the system message,
+# ahead of the per-comment text, so every request shares the same prefix and
+# vLLM's prefix cache (--enable-prefix-caching) reuses its KV blocks.
+SYSTEM_PROMPT = """You are an expert document analyst. Determine if a comment made on an earlier document version was addressed in a newer version.
 
-Comment:
-{comment['comment_text']}
-
-Relevant text from VERSION 1 of the document:
-{v1_text}
-
-Relevant text from VERSION 2 of the document:
-{v2_text}
+The user message contains the comment, relevant text from VERSION 1 of the document and relevant text from VERSION 2 of the document.
 
 Based ONLY on the provided texts, determine if the comment was addressed in version 2.
 Your response MUST be ONLY a single, valid JSON object. Do NOT include ```json markers, introductory sentences, or any text outside the JSON object itself.
@@ -59,18 +32,249 @@ The JSON object MUST contain these fields, with string values in Russian:
 - "status": Exactly one of: "учтен", "не учтен", "частично учтен".
 
 Example of the required EXACT output format:
-{{
+{
   "explanation": "Комментарий был полностью учтен путем добавления нового раздела 3.2.",
   "evidence_v1": "Раздел 3 отсутствует.",
   "evidence_v2": "Раздел 3.2: Описание новой функции.",
   "suggestion": "",
   "status": "учтен"
-}}
+}
+"""
+
+# From the first "{" to the last "}": the JSON object, minus any prose or
+# code fences the model wrapped around it. Greedy, so nested objects and
+# braces inside string values stay part of the match.
+JSON_OBJECT_RE = re.compile(r"\{[\s\S]*\}")
+
+# Retrieved chunks only feed _format_chunks, which reads just their text.
+RETRIEVED_PAYLOAD = ["text"]
+
+# Per-comment user message; the static instructions are in SYSTEM_PROMPT.
+PROMPT_TEMPLATE = """Comment:
+{comment}
+
+Relevant text from VERSION 1 of the document:
+{v1}
+
+Relevant text from VERSION 2 of the document:
+{v2}
 
 Now, generate the JSON object for the provided comment and texts. Respond ONLY with the JSON object.
 """
 
-        llm_response = self.llm_client.get_completion(prompt)
+
+class CommentAnalyzer:
+    def __init__(self, vector_store, llm_client, top_k=10, semantic_cache=None):
+        self.vector_store = vector_store
+        self.llm_client = llm_client
+        self.top_k = top_k
+        self.semantic_cache = semantic_cache or create_semantic_cache(vector_store)
+        # Formatted evidence per document pair, keyed by version and the ranked
+        # chunk ids, so comments retrieving the same chunks share one string.
+        self._evidence_texts: Dict[str, Dict[Tuple, str]] = {}
+        # Comments waiting on an LLM verdict, by (namespace, evidence key):
+        # each entry is the comment's normalized embedding and a future that
+        # receives its verdict (None if it failed). A near-duplicate arriving
+        # meanwhile awaits that verdict instead of issuing its own call.
+        self._pending: Dict[
+            Tuple[str, str], List[Tuple[np.ndarray, asyncio.Future]]
+        ] = {}
+
+    async def analyze_all(
+        self,
+        comments: List[Dict],
+        doc_base_name: str,
+        cache_namespace: str,
+        on_progress: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> List[Dict]:
+        # doc_base_name names the collections to search; cache_namespace (see
+        # cache_namespace()) scopes the semantic cache, so verdicts carry over
+        # between tasks on the same documents.
+        # Retrieval for every comment is one batched search per version. Then
+        # each comment runs as its own coroutine, with at most
+        # LLM_MAX_CONCURRENCY of them past the semaphore at a time, so the
+        # LLM calls of different comments overlap. on_progress receives the
+        # number of comments finished so far.
+        v1_hits, v2_hits = await self._retrieve(comments, doc_base_name)
+        limit = asyncio.Semaphore(config.LLM_MAX_CONCURRENCY)
+        done = 0
+
+        async def run(comment: Dict, v1_results, v2_results) -> Dict:
+            nonlocal done
+            async with limit:
+                result = await self._analyze(
+                    comment, doc_base_name, cache_namespace, v1_results, v2_results
+                )
+            done += 1
+            if on_progress is not None:
+                await on_progress(done)
+            return result
+
+        return await _gather_or_cancel(
+            run(*args) for args in zip(comments, v1_hits, v2_hits)
+        )
+
+    async def _analyze(
+        self,
+        comment: Dict,
+        doc_base_name: str,
+        cache_namespace: str,
+        v1_results,
+        v2_results,
+    ) -> Dict:
+        missing = self._missing_evidence(comment, v1_results, v2_results)
+        if missing is not None:
+            return missing
+        evidence_key = _evidence_key(v1_results, v2_results)
+        key = (cache_namespace, evidence_key)
+        embedding = normalize(comment["embedding"])
+
+        shared = self._find_pending(key, embedding)
+        if shared is not None:
+            # Shielded: cancelling this comment must not cancel the other's.
+            verdict = await asyncio.shield(shared)
+            if verdict is not None:
+                return _with_verdict(comment, verdict)
+
+        # Registered before the first await, so every comment that starts
+        # after this point sees it.
+        future = asyncio.get_running_loop().create_future()
+        entry = (embedding, future)
+        self._pending.setdefault(key, []).append(entry)
+        result = None
+        try:
+            result = await self._resolve(
+                comment,
+                doc_base_name,
+                cache_namespace,
+                evidence_key,
+                v1_results,
+                v2_results,
+            )
+            return result
+        finally:
+            pending = self._pending[key]
+            pending.remove(entry)
+            if not pending:
+                del self._pending[key]
+            future.set_result(
+                result if result is not None and result["status"] != "error" else None
+            )
+
+    async def _resolve(
+        self,
+        comment: Dict,
+        doc_base_name: str,
+        cache_namespace: str,
+        evidence_key: str,
+        v1_results,
+        v2_results,
+    ) -> Dict:
+        # Cache operations may hit Qdrant through the sync client, so they run
+        # in a worker thread.
+        cached = await asyncio.to_thread(
+            self._lookup_cache, comment, cache_namespace, evidence_key
+        )
+        if cached is not None:
+            return cached
+
+        prompt = self._build_prompt(comment, doc_base_name, v1_results, v2_results)
+        llm_response = await self.llm_client.aget_completion(
+            prompt, system=SYSTEM_PROMPT
+        )
+        return await asyncio.to_thread(
+            self._store_result,
+            comment,
+            cache_namespace,
+            evidence_key,
+            self._parse_response(comment, llm_response),
+        )
+
+    def forget(self, doc_base_name: str):
+        # Semantic cache entries outlive the task and expire on their own.
+        self._evidence_texts.pop(doc_base_name, None)
+
+    def _missing_evidence(
+        self, comment: Dict, v1_results, v2_results
+    ) -> Optional[Dict]:
+        # Without chunks from both versions there is nothing to compare, so
+        # the comment fails here instead of costing an LLM call.
+        empty = [
+            version
+            for version, results in (("V1", v1_results), ("V2", v2_results))
+            if not results
+        ]
+        if not empty:
+            return None
+        logger.warning(
+            f"No chunks retrieved from {', '.join(empty)} "
+            f"for comment {comment['comment_id']}"
+        )
+        return self._create_error_result(
+            comment, LookupError(f"no chunks retrieved from {', '.join(empty)}")
+        )
+
+    def _find_pending(
+        self, key: Tuple[str, str], embedding: np.ndarray
+    ) -> Optional[asyncio.Future]:
+        for row, future in self._pending.get(key, ()):
+            if float(row @ embedding) >= self.semantic_cache.threshold:
+                return future
+        return None
+
+    def _lookup_cache(
+        self, comment: Dict, cache_namespace: str, evidence_key: str
+    ) -> Optional[Dict]:
+        cached = self.semantic_cache.lookup(
+            cache_namespace, evidence_key, comment["embedding"]
+        )
+        if cached is None:
+            return None
+        return _with_verdict(comment, cached)
+
+    def _store_result(
+        self, comment: Dict, cache_namespace: str, evidence_key: str, result: Dict
+    ) -> Dict:
+        if result["status"] != "error":
+            self.semantic_cache.insert(
+                cache_namespace, evidence_key, comment["embedding"], result
+            )
+        return result
+
+    async def _retrieve(self, comments: List[Dict], doc_base_name: str):
+        embeddings = [c["embedding"] for c in comments]
+        return await _gather_or_cancel(
+            self.vector_store.asearch_batch(
+                template(doc_base_name), embeddings, self.top_k, RETRIEVED_PAYLOAD
+            )
+            for template in (
+                config.V1_COLLECTION_TEMPLATE,
+                config.V2_COLLECTION_TEMPLATE,
+            )
+        )
+
+    def _build_prompt(
+        self, comment: Dict, doc_base_name: str, v1_results, v2_results
+    ) -> str:
+        logger.info(
+            f"Analyzing comment {comment['comment_id']}: '{comment['comment_text'][:50]}...'"
+        )
+
+        return PROMPT_TEMPLATE.format(
+            comment=comment["comment_text"],
+            v1=self._format_evidence(doc_base_name, "v1", v1_results),
+            v2=self._format_evidence(doc_base_name, "v2", v2_results),
+        )
+
+    def _format_evidence(self, doc_base_name: str, version: str, results) -> str:
+        texts = self._evidence_texts.setdefault(doc_base_name, {})
+        key = (version, tuple(hit.id for hit in results))
+        text = texts.get(key)
+        if text is None:
+            text = texts[key] = _format_chunks(results)
+        return text
+
+    def _parse_response(self, comment: Dict, llm_response: Optional[str]) -> Dict:
         if not llm_response:
             logger.error(
                 f"LLM returned empty response for comment {comment['comment_id']}"
@@ -78,14 +282,10 @@ Now, generate the JSON object for the provided comment and texts. Respond ONLY w
             return self._create_error_result(comment, None)
 
         try:
-            json_text = llm_response.strip()
-            first_brace = json_text.find("{")
-            last_brace = json_text.rfind("}")
-
-            if first_brace != -1 and last_brace != -1:
-                json_text = json_text[first_brace : last_brace + 1]
+            match = JSON_OBJECT_RE.search(llm_response)
+            json_text = match.group(0) if match else llm_response.strip()
 
-            result = json.loads(json_text)
+            result = orjson.loads(json_text)
 
             return {
                 "comment_id": comment["comment_id"],
@@ -121,3 +321,62 @@ Now, generate the JSON object for the provided comment and texts. Respond ONLY w
             "suggestion": "",
             "status": "error",
         }
+
+
+async def _gather_or_cancel(coros) -> List:
+    # Like asyncio.gather, but when one coroutine fails the others are
+    # cancelled, and have finished unwinding, before the error propagates; so
+    # nothing keeps calling the LLM or reporting progress for a failed task.
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+
+def cache_namespace(v1_chunks: List[Dict], v2_chunks: List[Dict]) -> str:
+    # Semantic cache namespace for a document pair: a verdict depends on the
+    # chunk texts (and so on the chunking settings), the models that embed and
+    # judge them, and the prompt. Chunk ids are chunk indexes, so equal
+    # namespaces also mean equal evidence keys for the same chunks.
+    digest = hashlib.sha1()
+    for part in (
+        config.EMBEDDING_MODEL_NAME,
+        config.DEFAULT_DOC_PREFIX,
+        config.DEFAULT_COMMENT_PREFIX,
+        config.VLLM_MODEL,
+        SYSTEM_PROMPT,
+        PROMPT_TEMPLATE,
+    ):
+        digest.update(part.encode() + b"\0")
+    for version, chunks in ((b"v1", v1_chunks), (b"v2", v2_chunks)):
+        digest.update(version + b"\0")
+        for chunk in chunks:
+            digest.update(chunk["text"].encode() + b"\0")
+    return digest.hexdigest()
+
+
+def _with_verdict(comment: Dict, verdict: Dict) -> Dict:
+    # Another comment's verdict, attributed to this comment.
+    return {
+        "comment_id": comment["comment_id"],
+        "comment_text": comment["comment_text"],
+        **{field: verdict[field] for field in CACHED_FIELDS},
+    }
+
+
+def _format_chunks(results) -> str:
+    return "\n\n".join(
+        f"Chunk {i+1}:\n{hit.payload['text']}" for i, hit in enumerate(results)
+    )
+
+
+def _evidence_key(v1_results, v2_results) -> str:
+    # Chunk ids are only unique within a collection, so the two versions are
+    # hashed as separate sorted lists.
+    v1_ids = sorted(hit.id for hit in v1_results)
+    v2_ids = sorted(hit.id for hit in v2_results)
+    return hashlib.sha1(f"{v1_ids}|{v2_ids}".encode()).hexdigest()
@@ -1,24 +1,44 @@
+import mmap
 import os
+import re
+import numpy as np
 import pandas as pd
-from typing import List, Dict, Any, Optional
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from sentence_transformers import SentenceTransformer
 import logging
 import pypdf
 
-from ..config import settings
+try:
+    # PyMuPDF's C extractor is much faster than pypdf; pypdf stays as the
+    # fallback when it is not installed.
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+from .. import config
+from .embedding_cache import EmbeddingCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ENCODE_BLOCK_SIZE = 256
+
+# The line breaks text-mode reading recognises (universal newlines); unlike
+# str.splitlines() it leaves \x0b, \x0c, \u2028 and the like inside a line.
+LINE_BREAK_RE = re.compile(r"\r\n|\r|\n")
+
 
 class DocumentProcessor:
     def __init__(self):
-        self.embedding_model_name = settings.EMBEDDING_MODEL_NAME
-        self.chunk_size = settings.CHUNK_SIZE
-        self.chunk_overlap = settings.CHUNK_OVERLAP
-        self.doc_prefix = settings.DEFAULT_DOC_PREFIX
-        self.comment_prefix = settings.DEFAULT_COMMENT_PREFIX
+        self.embedding_model_name = config.EMBEDDING_MODEL_NAME
+        self.chunk_size = config.CHUNK_SIZE
+        self.chunk_overlap = config.CHUNK_OVERLAP
+        self.doc_prefix = config.DEFAULT_DOC_PREFIX
+        self.comment_prefix = config.DEFAULT_COMMENT_PREFIX
+        self.batch_size = config.EMBEDDING_BATCH_SIZE
 
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=self.chunk_size,
@@ -27,36 +47,108 @@ class DocumentProcessor:
         )
 
         logger.info(f"Loading embedding model: {self.embedding_model_name}")
-        self.embedding_model = SentenceTransformer(self.embedding_model_name)
+        torch.set_num_threads(config.TORCH_NUM_THREADS or os.cpu_count())
+        self.embedding_model = self._load_embedding_model()
+        # What produced the vectors besides the model itself; embeddings from
+        # another backend, export or precision are not reused from the cache.
+        backend = self.embedding_model.backend
+        if backend == "torch":
+            variant = f"torch:{self._set_dtype(config.EMBEDDING_DTYPE)}"
+        else:
+            variant = f"{backend}:{config.EMBEDDING_ONNX_FILE or 'default'}"
         logger.info("Embedding model loaded successfully")
 
-    def load_document_text(self, file_path: str) -> Optional[str]:
+        self.embedding_cache = (
+            EmbeddingCache(
+                config.EMBEDDING_CACHE_DIR, self.embedding_model_name, variant
+            )
+            if config.EMBEDDING_CACHE_DIR
+            else None
+        )
+
+    def _set_dtype(self, dtype: str) -> str:
+        if dtype == "auto":
+            dtype = "float16" if torch.cuda.is_available() else "float32"
+        if dtype != "float32":
+            logger.info(f"Casting embedding model to {dtype}")
+            self.embedding_model.to(getattr(torch, dtype))
+        return dtype
+
+    def _load_embedding_model(self) -> SentenceTransformer:
+        backend = config.EMBEDDING_BACKEND
+        if backend != "torch":
+            model_kwargs = {}
+            if config.EMBEDDING_ONNX_FILE:
+                model_kwargs["file_name"] = config.EMBEDDING_ONNX_FILE
+            try:
+                return SentenceTransformer(
+                    self.embedding_model_name,
+                    device=config.EMBEDDING_DEVICE,
+                    backend=backend,
+                    model_kwargs=model_kwargs,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Failed to load {backend} embedding backend, using torch: {e}"
+                )
+        return SentenceTransformer(
+            self.embedding_model_name, device=config.EMBEDDING_DEVICE
+        )
+
+    def _encode(self, texts: List[str], prefix: str):
+        return self._encode_with_prefixes(texts, [prefix] * len(texts))
+
+    def _encode_with_prefixes(self, texts: List[str], prefixes: List[str]):
+        if self.embedding_cache is not None:
+            return self.embedding_cache.encode(texts, prefixes, self._encode_uncached)
+        return self._encode_uncached(texts, prefixes)
+
+    def _encode_uncached(self, texts: List[str], prefixes: List[str]):
+        # The prefixes are prepended here, which is all encode(prompt=...)
+        # does for this model, so texts with different prefixes can share a
+        # call. encode() already orders its inputs by length before batching,
+        # so each batch is padded to similar lengths, and returns embeddings
+        # in input order; no extra sorting is needed here.
+        return self.embedding_model.encode(
+            [prefix + text for prefix, text in zip(prefixes, texts)],
+            batch_size=self.batch_size,
+            show_progress_bar=False,
+        )
+
+    def _locate(self, file_path: str) -> Optional[str]:
         if os.path.exists(file_path):
-            path = file_path
-        elif os.path.exists(os.path.join("/app", file_path)):
-            path = os.path.join("/app", file_path)
-        else:
-            logger.error(f"File not found: {file_path}")
+            return file_path
+        if os.path.exists(os.path.join("/app", file_path)):
+            return os.path.join("/app", file_path)
+        logger.error(f"File not found: {file_path}")
+        return None
+
+    def iter_document_pages(self, file_path: str) -> Optional[Iterator[str]]:
+        # None if the file is missing or of an unsupported type; otherwise a
+        # lazy iterator over the document's text, one page at a time.
+        path = self._locate(file_path)
+        if path is None:
             return None
 
         logger.info(f"Loading document from: {path}")
         ext = os.path.splitext(path)[1].lower()
 
-        try:
-            if ext == ".txt":
-                with open(path, "r", encoding="utf-8") as f:
-                    content = f.read()
-            elif ext == ".pdf":
-                reader = pypdf.PdfReader(path)
-                content = ""
-                for page in reader.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        content += page_text + "\n\n"
-            else:
-                logger.error(f"Unsupported file format: {ext}")
-                return None
+        if ext == ".txt":
+            return self._text_pages(path)
+        if ext == ".pdf":
+            return (
+                page_text + "\n\n" for page_text in self._pdf_pages(path) if page_text
+            )
+        logger.error(f"Unsupported file format: {ext}")
+        return None
 
+    def load_document_text(self, file_path: str) -> Optional[str]:
+        pages = self.iter_document_pages(file_path)
+        if pages is None:
+            return None
+
+        try:
+            content = "".join(pages)
             logger.info(f"Document loaded: {len(content)} chars")
             return content
 
@@ -64,24 +156,62 @@ class DocumentProcessor:
             logger.error(f"Error loading document: {e}")
             return None
 
-    def load_comments(self, file_path: str) -> Optional[List[Dict[str, Any]]]:
-        if os.path.exists(file_path):
-            path = file_path
-        elif os.path.exists(os.path.join("/app", file_path)):
-            path = os.path.join("/app", file_path)
+    def iter_document_chunks(self, pages: Iterable[str]) -> Iterator[str]:
+        # Splits the text as it arrives instead of joining the whole document
+        # first. Only the last, possibly unfinished, chunk of what has been
+        # read so far is carried over to be split again with the next page.
+        # No text is lost, but chunk boundaries may differ from split_text()
+        # on the joined document, since the splitter sees each piece without
+        # the text that follows it.
+        buffer = ""
+        for page in pages:
+            buffer += page
+            if len(buffer) <= self.chunk_size + self.chunk_overlap:
+                continue
+            pieces = self.text_splitter.split_text(buffer)
+            if not pieces:
+                buffer = ""
+                continue
+            yield from pieces[:-1]
+            # split_text strips chunks; keep the page separator after the tail.
+            buffer = pieces[-1] + buffer[len(buffer.rstrip()) :]
+        if buffer:
+            yield from self.text_splitter.split_text(buffer)
+
+    def _text_pages(self, path: str) -> Iterator[str]:
+        with open(path, "r", encoding="utf-8") as f:
+            yield f.read()
+
+    def _pdf_pages(self, path: str):
+        if pymupdf is not None:
+            with pymupdf.open(path) as doc:
+                for page in doc:
+                    yield page.get_text("text")
         else:
-            logger.error(f"File not found: {file_path}")
+            for page in pypdf.PdfReader(path).pages:
+                yield page.extract_text()
+
+    def load_comments(self, file_path: str) -> Optional[List[Dict[str, Any]]]:
+        path = self._locate(file_path)
+        if path is None:
             return None
 
         logger.info(f"Loading comments from: {path}")
 
         try:
-            comments = []
-            with open(path, "r", encoding="utf-8") as f:
-                for i, line in enumerate(f):
-                    text = line.strip()
-                    if text:
-                        comments.append({"comment_id": f"C{i+1}", "comment_text": text})
+            # One decode of the mapped file and one regex split instead of
+            # decoding line by line. Ids keep counting blank lines, as before.
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    lines = []
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        lines = LINE_BREAK_RE.split(mm[:].decode("utf-8"))
+            comments = [
+                {"comment_id": f"C{i+1}", "comment_text": text}
+                for i, text in enumerate(line.strip() for line in lines)
+                if text
+            ]
 
             logger.info(f"Loaded {len(comments)} comments")
             return comments
@@ -93,33 +223,49 @@ class DocumentProcessor:
     def process_document(self, file_path: str) -> Optional[Dict[str, Any]]:
         logger.info(f"Processing document: {file_path}")
 
-        text = self.load_document_text(file_path)
-        if not text:
+        pages = self.iter_document_pages(file_path)
+        if pages is None:
             return None
 
-        chunks = self.text_splitter.split_text(text)
-        if not chunks:
-            logger.warning("No chunks generated")
-            return {"original_text": text, "chunks": []}
+        processed_chunks = []
+        block = []
 
-        try:
-            embeddings = self.embedding_model.encode(
-                chunks, prompt=self.doc_prefix, show_progress_bar=False
+        def flush():
+            # Embeddings stay rows of one float32 array; nothing downstream
+            # needs them as Python lists.
+            embeddings = np.asarray(
+                self._encode(block, self.doc_prefix), dtype=np.float32
             )
-
-            processed_chunks = []
-            for i, (chunk_text, emb) in enumerate(zip(chunks, embeddings)):
+            for chunk_text, embedding in zip(block, embeddings):
                 processed_chunks.append(
-                    {"text": chunk_text, "embedding": emb.tolist(), "chunk_index": i}
+                    {
+                        "text": chunk_text,
+                        "embedding": embedding,
+                        "chunk_index": len(processed_chunks),
+                    }
                 )
+            block.clear()
 
-            logger.info(f"Document processed: {len(chunks)} chunks")
-            return {"original_text": text, "chunks": processed_chunks}
+        try:
+            # Chunks are embedded ENCODE_BLOCK_SIZE at a time while the rest of
+            # the document is still being read.
+            for chunk_text in self.iter_document_chunks(pages):
+                block.append(chunk_text)
+                if len(block) == ENCODE_BLOCK_SIZE:
+                    flush()
+            if block:
+                flush()
 
         except Exception as e:
-            logger.error(f"Error embedding document chunks: {e}")
+            logger.error(f"Error processing document {file_path}: {e}")
             return None
 
+        if not processed_chunks:
+            logger.warning("No chunks generated")
+        else:
+            logger.info(f"Document processed: {len(processed_chunks)} chunks")
+        return {"chunks": processed_chunks}
+
     def process_comments(self, file_path: str) -> Optional[List[Dict[str, Any]]]:
         logger.info(f"Processing comments: {file_path}")
 
@@ -130,12 +276,11 @@ class DocumentProcessor:
         texts = [c["comment_text"] for c in comments]
 
         try:
-            embeddings = self.embedding_model.encode(
-                texts, prompt=self.comment_prefix, show_progress_bar=False
-            )
+            embeddings = self._encode(texts, self.comment_prefix)
 
+            embeddings = np.asarray(embeddings, dtype=np.float32)
             for comment, embedding in zip(comments, embeddings):
-                comment["embedding"] = embedding.tolist()
+                comment["embedding"] = embedding
 
             logger.info(f"Comments processed: {len(comments)}")
             return comments
@@ -143,3 +288,90 @@ class DocumentProcessor:
         except Exception as e:
             logger.error(f"Error embedding comments: {e}")
             return None
+
+    def process_pair(
+        self,
+        doc_v1_path: str,
+        doc_v2_path: str,
+        comments_path: str,
+        on_step: Optional[Callable[[str], None]] = None,
+    ):
+        # Same results as process_document(v1), process_document(v2) and
+        # process_comments(), but every text goes through a single encode
+        # call, so the model runs on full batches instead of three partly
+        # filled ones. Entries are None where the matching method would
+        # return None.
+        # The files are read and split in parallel threads; on_step receives
+        # "processing_v2" once v1 is split and "processing_comments" once v2
+        # is, and is called from the worker thread.
+        logger.info(
+            f"Processing documents {doc_v1_path}, {doc_v2_path} "
+            f"and comments {comments_path}"
+        )
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            splits = [
+                pool.submit(self._split_document, path)
+                for path in (doc_v1_path, doc_v2_path)
+            ]
+            loaded_comments = pool.submit(self.load_comments, comments_path)
+            doc_chunks = []
+            for split, next_step in zip(
+                splits, ("processing_v2", "processing_comments")
+            ):
+                doc_chunks.append(split.result())
+                if on_step is not None:
+                    on_step(next_step)
+            comments = loaded_comments.result()
+
+        texts, prefixes = [], []
+        for chunks in doc_chunks:
+            if chunks:
+                texts += chunks
+                prefixes += [self.doc_prefix] * len(chunks)
+        for comment in comments or ():
+            texts.append(comment["comment_text"])
+            prefixes.append(self.comment_prefix)
+
+        try:
+            embeddings = np.asarray(
+                self._encode_with_prefixes(texts, prefixes) if texts else [],
+                dtype=np.float32,
+            )
+        except Exception as e:
+            logger.error(f"Error embedding documents and comments: {e}")
+            return None, None, None
+
+        rows = iter(embeddings)
+        processed_docs = []
+        for chunks in doc_chunks:
+            if chunks is None:
+                processed_docs.append(None)
+                continue
+            processed_docs.append(
+                {
+                    "chunks": [
+                        {"text": chunk_text, "embedding": next(rows), "chunk_index": i}
+                        for i, chunk_text in enumerate(chunks)
+                    ]
+                }
+            )
+        for comment in comments or ():
+            comment["embedding"] = next(rows)
+
+        logger.info(
+            f"Processed {len(texts)} texts in one pass: "
+            f"{len(doc_chunks[0] or ())} + {len(doc_chunks[1] or ())} chunks, "
+            f"{len(comments or ())} comments"
+        )
+        return processed_docs[0], processed_docs[1], comments
+
+    def _split_document(self, file_path: str) -> Optional[List[str]]:
+        pages = self.iter_document_pages(file_path)
+        if pages is None:
+            return None
+        try:
+            return list(self.iter_document_chunks(pages))
+        except Exception as e:
+            logger.error(f"Error processing document {file_path}: {e}")
+            return None
@@ -0,0 +1,57 @@
+import hashlib
+import logging
+from typing import Callable, List, Sequence
+
+import diskcache
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Content-addressed store for embeddings, so re-running an analysis on the
+# same documents or comments only encodes texts it has not seen before.
+# Entries are keyed by model, variant (backend and dtype or ONNX export),
+# prompt prefix and text, and hold raw float32 bytes.
+class EmbeddingCache:
+    def __init__(self, directory: str, model_name: str, variant: str):
+        self.model_name = model_name
+        self.variant = variant
+        self._cache = diskcache.Cache(directory)
+
+    def _key(self, prefix: str, text: str) -> str:
+        return hashlib.sha1(
+            f"{self.model_name}\0{self.variant}\0{prefix}\0{text}".encode()
+        ).hexdigest()
+
+    def encode(
+        self,
+        texts: List[str],
+        prefixes: Sequence[str],
+        encode: Callable[[List[str], List[str]], np.ndarray],
+    ) -> np.ndarray:
+        # prefixes[i] is the prompt prefix of texts[i]; encode() is called
+        # with the texts and prefixes of the misses only.
+        keys = [self._key(prefix, text) for prefix, text in zip(prefixes, texts)]
+        rows = [self._cache.get(key) for key in keys]
+        misses = [i for i, row in enumerate(rows) if row is None]
+        if misses:
+            logger.info(
+                f"Embedding cache: {len(texts) - len(misses)} hits, "
+                f"{len(misses)} misses"
+            )
+            fresh = np.asarray(
+                encode([texts[i] for i in misses], [prefixes[i] for i in misses]),
+                dtype=np.float32,
+            )
+            with self._cache.transact():
+                for i, row in zip(misses, fresh):
+                    self._cache.set(keys[i], row.tobytes())
+                    rows[i] = row
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(
+            [
+                np.frombuffer(row, dtype=np.float32) if isinstance(row, bytes) else row
+                for row in rows
+            ]
+        )
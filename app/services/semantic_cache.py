@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from qdrant_client.http.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    MatchValue,
+    PointStruct,
+    Range,
+)
+
+from .. import config
+
+logger = logging.getLogger(__name__)
+
+# Verdict fields reused on a cache hit; id and text always come from the
+# comment being analyzed.
+CACHED_FIELDS = ("explanation", "evidence_v1", "evidence_v2", "suggestion", "status")
+
+_INITIAL_CAPACITY = 16
+
+
+def normalize(embedding: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class _Bucket:
+    # Unit-normalized embeddings stacked row-wise in a preallocated matrix
+    # that doubles when full, so inserts are amortized O(d) and lookups stay
+    # a single BLAS matvec over the filled rows.
+    def __init__(self, dim: int):
+        self.matrix = np.empty((_INITIAL_CAPACITY, dim), dtype=np.float32)
+        self.expires_at = np.empty(_INITIAL_CAPACITY, dtype=np.float64)
+        self.results: List[Dict] = []
+
+    def append(self, row: np.ndarray, result: Dict, expires_at: float):
+        size = len(self.results)
+        if size == len(self.matrix):
+            grown = np.empty((2 * size, self.matrix.shape[1]), dtype=np.float32)
+            grown[:size] = self.matrix
+            self.matrix = grown
+            self.expires_at = np.resize(self.expires_at, 2 * size)
+        self.matrix[size] = row
+        self.expires_at[size] = expires_at
+        self.results.append(result)
+
+    def compact(self, now: float) -> int:
+        # Drops expired rows; returns how many are left.
+        live = np.flatnonzero(self.expires_at[: len(self.results)] > now)
+        if len(live):
+            self.matrix = self.matrix[live]
+            self.expires_at = self.expires_at[live]
+        self.results = [self.results[i] for i in live]
+        return len(live)
+
+    def scores(self, query: np.ndarray, now: float) -> np.ndarray:
+        size = len(self.results)
+        scores = self.matrix[:size] @ query
+        scores[self.expires_at[:size] <= now] = -np.inf
+        return scores
+
+
+# Reuses analysis results for near-duplicate comments, within a task and
+# across tasks on the same documents. Entries are grouped by namespace (a hash
+# of the analyzed document pair, see comment_analyzer.cache_namespace) and
+# evidence key (the chunks retrieved for the comment), since a verdict only
+# carries over to a similar comment judged against the same evidence. Entries
+# expire after `ttl` seconds; expired ones are swept at most once per `ttl`.
+class SemanticCache:
+    def __init__(self, threshold: float, ttl: float):
+        self.threshold = threshold
+        self.ttl = ttl
+        self._buckets: Dict[str, Dict[str, _Bucket]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.time() + ttl
+
+    def lookup(
+        self, namespace: str, evidence_key: str, embedding: Sequence[float]
+    ) -> Optional[Dict]:
+        with self._lock:
+            bucket = self._buckets.get(namespace, {}).get(evidence_key)
+            if bucket is None:
+                return None
+            # Rows are unit-normalized, so one matvec gives every cosine score.
+            scores = bucket.scores(normalize(embedding), time.time())
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            logger.info(f"Semantic cache hit in {namespace} (score {scores[best]:.3f})")
+            return bucket.results[best]
+
+    def insert(
+        self,
+        namespace: str,
+        evidence_key: str,
+        embedding: Sequence[float],
+        result: Dict,
+    ):
+        row = normalize(embedding)
+        cached = {field: result[field] for field in CACHED_FIELDS}
+        now = time.time()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            buckets = self._buckets.setdefault(namespace, {})
+            bucket = buckets.get(evidence_key)
+            if bucket is None:
+                bucket = buckets[evidence_key] = _Bucket(row.shape[0])
+            bucket.append(row, cached, now + self.ttl)
+
+    def _sweep(self, now: float):
+        for namespace, buckets in list(self._buckets.items()):
+            for evidence_key, bucket in list(buckets.items()):
+                if not bucket.compact(now):
+                    del buckets[evidence_key]
+            if not buckets:
+                del self._buckets[namespace]
+        self._next_sweep = now + self.ttl
+
+
+# Same interface as SemanticCache, backed by a Qdrant collection so lookups
+# use its HNSW index instead of a linear scan, and entries are shared by every
+# API worker and survive restarts.
+class QdrantSemanticCache:
+    def __init__(
+        self, vector_store, threshold: float, ttl: float, collection_name: str
+    ):
+        self.client = vector_store.client
+        self.threshold = threshold
+        self.ttl = ttl
+        self.collection_name = collection_name
+        self._next_sweep = 0.0
+        vector_store.ensure_collection(
+            collection_name,
+            distance=Distance.COSINE,
+            keyword_fields=("namespace", "evidence_key"),
+        )
+
+    def lookup(
+        self, namespace: str, evidence_key: str, embedding: Sequence[float]
+    ) -> Optional[Dict]:
+        hits = self.client.search(
+            collection_name=self.collection_name,
+            query_vector=np.asarray(embedding, dtype=np.float32).tolist(),
+            query_filter=Filter(
+                must=[
+                    _match("namespace", namespace),
+                    _match("evidence_key", evidence_key),
+                    FieldCondition(key="expires_at", range=Range(gt=time.time())),
+                ]
+            ),
+            limit=1,
+            score_threshold=self.threshold,
+            with_payload=list(CACHED_FIELDS),
+        )
+        if not hits:
+            return None
+        logger.info(f"Semantic cache hit in {namespace} (score {hits[0].score:.3f})")
+        return {field: hits[0].payload[field] for field in CACHED_FIELDS}
+
+    def insert(
+        self,
+        namespace: str,
+        evidence_key: str,
+        embedding: Sequence[float],
+        result: Dict,
+    ):
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.ttl
+            self.client.delete(
+                collection_name=self.collection_name,
+                points_selector=FilterSelector(
+                    filter=Filter(
+                        must=[FieldCondition(key="expires_at", range=Range(lte=now))]
+                    )
+                ),
+            )
+        self.client.upsert(
+            collection_name=self.collection_name,
+            points=[
+                PointStruct(
+                    id=uuid.uuid4().hex,
+                    vector=np.asarray(embedding, dtype=np.float32).tolist(),
+                    payload={
+                        "namespace": namespace,
+                        "evidence_key": evidence_key,
+                        "expires_at": now + self.ttl,
+                        **{field: result[field] for field in CACHED_FIELDS},
+                    },
+                )
+            ],
+            wait=True,
+        )
+
+
+def _match(key: str, value: str) -> FieldCondition:
+    return FieldCondition(key=key, match=MatchValue(value=value))
+
+
+def create_semantic_cache(vector_store):
+    backend = config.SEMANTIC_CACHE_BACKEND
+    if backend == "memory":
+        return SemanticCache(
+            config.SEMANTIC_CACHE_THRESHOLD, config.SEMANTIC_CACHE_TTL_SECONDS
+        )
+    if backend == "qdrant":
+        return QdrantSemanticCache(
+            vector_store,
+            config.SEMANTIC_CACHE_THRESHOLD,
+            config.SEMANTIC_CACHE_TTL_SECONDS,
+            config.QDRANT_SEMANTIC_CACHE_COLLECTION,
+        )
+    raise ValueError(f"Unknown SEMANTIC_CACHE_BACKEND: {backend!r}")
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Optional
+
+import orjson
+
+from .. import config
+
+logger = logging.getLogger(__name__)
+
+# Task records expire together with their result files (see cleanup_old_files).
+TASK_TTL_SECONDS = 7 * 24 * 3600
+
+
+# Task state for a single API process. Readers get the live dict, so a result
+# loaded from disk once stays cached on it.
+class MemoryTaskStore:
+    def __init__(self):
+        self._tasks: Dict[str, Dict] = {}
+        # Set (and dropped) whenever a task's state changes; see update().
+        self._events: Dict[str, asyncio.Event] = {}
+
+    async def create(self, task_id: str, state: Dict):
+        self._tasks[task_id] = state
+
+    async def get(self, task_id: str) -> Optional[Dict]:
+        return self._tasks.get(task_id)
+
+    async def update(self, task_id: str, **fields):
+        self._tasks[task_id].update(fields)
+        changed = self._events.pop(task_id, None)
+        if changed is not None:
+            changed.set()
+
+    async def delete(self, task_id: str):
+        self._tasks.pop(task_id, None)
+        # Wakes any watcher, which then sees the task gone.
+        changed = self._events.pop(task_id, None)
+        if changed is not None:
+            changed.set()
+
+    async def watch(self, task_id: str, keepalive: float) -> AsyncIterator[Dict]:
+        # Yields the state now, then after every change (or every `keepalive`
+        # seconds without one) until the task finishes or disappears.
+        while True:
+            # Register for the next change before reading the state, so an
+            # update landing while the caller handles this one is not missed.
+            changed = self._events.setdefault(task_id, asyncio.Event())
+            state = self._tasks.get(task_id)
+            if state is None or state["status"] != "processing":
+                # No further changes to wait for, so nothing stays registered.
+                self._events.pop(task_id, None)
+                if state is not None:
+                    yield state
+                return
+            yield state
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Task state shared by every API worker. Each task is a hash whose fields hold
+# orjson-encoded values, so progress updates rewrite single fields instead of
+# the whole record, and changes are announced on a per-task channel.
+class RedisTaskStore:
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(task_id: str) -> str:
+        return f"task:{task_id}"
+
+    async def create(self, task_id: str, state: Dict):
+        await self._write(task_id, state)
+
+    async def get(self, task_id: str) -> Optional[Dict]:
+        raw = await self.redis.hgetall(self._key(task_id))
+        if not raw:
+            return None
+        return {field.decode(): orjson.loads(value) for field, value in raw.items()}
+
+    async def update(self, task_id: str, **fields):
+        await self._write(task_id, fields)
+        await self.redis.publish(self._key(task_id), b"")
+
+    async def delete(self, task_id: str):
+        await self.redis.delete(self._key(task_id))
+
+    async def watch(self, task_id: str, keepalive: float) -> AsyncIterator[Dict]:
+        pubsub = self.redis.pubsub()
+        try:
+            # Subscribed before the first read, for the same reason as in
+            # MemoryTaskStore.watch().
+            await pubsub.subscribe(self._key(task_id))
+            # Consume the subscription confirmation, which would otherwise
+            # end the first wait below straight away.
+            await pubsub.get_message(timeout=keepalive)
+            while True:
+                state = await self.get(task_id)
+                if state is None:
+                    return
+                yield state
+                if state["status"] != "processing":
+                    return
+                await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=keepalive
+                )
+        finally:
+            await pubsub.aclose()
+
+    async def _write(self, task_id: str, fields: Dict):
+        # Analysis results stay on disk (results_path) and are loaded on
+        # demand, so records stay small.
+        mapping = {
+            field: orjson.dumps(value)
+            for field, value in fields.items()
+            if field != "result"
+        }
+        if not mapping:
+            return
+        key = self._key(task_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, TASK_TTL_SECONDS)
+            await pipe.execute()
+
+
+def create_task_store():
+    backend = config.TASK_STORE_BACKEND
+    if backend == "memory":
+        return MemoryTaskStore()
+    if backend == "redis":
+        logger.info(f"Using Redis task store at {config.REDIS_URL}")
+        return RedisTaskStore(config.REDIS_URL)
+    raise ValueError(f"Unknown TASK_STORE_BACKEND: {backend!r}")
@@ -1,52 +1,169 @@
-from typing import List, Dict, Any
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+from typing import List, Dict, Any, Optional
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    Datatype,
+    Distance,
+    PayloadSchemaType,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    SearchRequest,
+    VectorParams,
+)
+import asyncio
 import logging
+import numpy as np
 
-from ..config import settings
+from .. import config
 
 logger = logging.getLogger(__name__)
 
+UPSERT_BATCH_SIZE = 512
+SEARCH_BATCH_SIZE = 256
+
+
+def _quantization_config(mode: str):
+    if mode == "none":
+        return None
+    if mode == "int8":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True)
+        )
+    if mode == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    raise ValueError(f"Unknown QDRANT_QUANTIZATION: {mode!r}")
+
+
+def _payload(payload_fields: Optional[List[str]]):
+    return True if payload_fields is None else payload_fields
+
 
 class VectorStoreService:
     def __init__(self):
         logger.info(
-            f"Connecting to Qdrant at {settings.QDRANT_HOST}:{settings.QDRANT_PORT}"
+            f"Connecting to Qdrant at {config.QDRANT_HOST}:{config.QDRANT_PORT}"
         )
-        self.client = QdrantClient(host=settings.QDRANT_HOST, port=settings.QDRANT_PORT)
+        connection = {
+            "host": config.QDRANT_HOST,
+            "port": config.QDRANT_PORT,
+            "grpc_port": config.QDRANT_GRPC_PORT,
+            "prefer_grpc": config.QDRANT_PREFER_GRPC,
+        }
+        self.client = QdrantClient(**connection)
+        # For searches issued from the event loop (CommentAnalyzer.analyze_all).
+        self.async_client = AsyncQdrantClient(**connection)
         logger.info("Successfully connected to Qdrant")
 
-        self.vector_size = settings.EMBEDDING_DIM
-        self.distance = Distance.COSINE
+        self.vector_size = config.EMBEDDING_DIM
+        self.distance = config.QDRANT_DISTANCE
+        self.quantization = _quantization_config(config.QDRANT_QUANTIZATION)
+        self.datatype = Datatype(config.QDRANT_VECTOR_DATATYPE)
+        # Searches go through the quantized index first, then rescore the
+        # oversampled candidates against the original vectors.
+        self.search_params = (
+            SearchParams(
+                quantization=QuantizationSearchParams(
+                    rescore=True, oversampling=config.QDRANT_OVERSAMPLING
+                )
+            )
+            if self.quantization is not None
+            else None
+        )
 
     def recreate_collection(self, collection_name: str):
         logger.info(f"Recreating collection: {collection_name}")
         self.client.recreate_collection(
             collection_name=collection_name,
-            vectors_config=VectorParams(size=self.vector_size, distance=self.distance),
+            vectors_config=self._vector_params(self.distance),
+            quantization_config=self.quantization,
         )
 
-    def upsert_chunks(self, collection_name: str, chunks: List[Dict[str, Any]]):
-        logger.info(f"Upserting {len(chunks)} chunks into {collection_name}")
-        points = []
-        for chunk in chunks:
-            points.append(
-                PointStruct(
-                    id=chunk["chunk_index"],
-                    vector=chunk["embedding"],
-                    payload={
-                        "text": chunk["text"],
-                        "chunk_index": chunk["chunk_index"],
-                    },
-                )
+    def ensure_collection(
+        self,
+        collection_name: str,
+        distance: Distance | None = None,
+        keyword_fields: tuple = (),
+    ):
+        if self.client.collection_exists(collection_name):
+            return
+        logger.info(f"Creating collection: {collection_name}")
+        self.client.create_collection(
+            collection_name=collection_name,
+            vectors_config=self._vector_params(distance or self.distance),
+            quantization_config=self.quantization,
+        )
+        for field_name in keyword_fields:
+            self.client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field_name,
+                field_schema=PayloadSchemaType.KEYWORD,
             )
-        self.client.upsert(collection_name=collection_name, points=points, wait=True)
 
-    def search(self, collection_name: str, query_vector: List[float], limit: int = 5):
-        logger.info(f"Searching {collection_name} for top {limit} results")
-        return self.client.search(
+    def _vector_params(self, distance: Distance) -> VectorParams:
+        # The quantized copy stays in RAM for search; the originals are only
+        # read for rescoring, so they can be kept on disk.
+        return VectorParams(
+            size=self.vector_size,
+            distance=distance,
+            datatype=self.datatype,
+            on_disk=self.quantization is not None,
+        )
+
+    def upsert_chunks(self, collection_name: str, chunks: List[Dict[str, Any]]):
+        logger.info(
+            f"Upserting {len(chunks)} chunks into {collection_name} "
+            f"(~{len(chunks) * config.EMBEDDING_VECTOR_BYTES // 1024} KiB of vectors)"
+        )
+        # upload_collection takes the float32 matrix as is, so no per-vector
+        # lists or PointStructs are built; it sends UPSERT_BATCH_SIZE points
+        # per request.
+        self.client.upload_collection(
             collection_name=collection_name,
-            query_vector=query_vector,
-            limit=limit,
-            with_payload=True,
+            vectors=np.stack([chunk["embedding"] for chunk in chunks]),
+            payload=(
+                {"text": chunk["text"], "chunk_index": chunk["chunk_index"]}
+                for chunk in chunks
+            ),
+            ids=[chunk["chunk_index"] for chunk in chunks],
+            batch_size=UPSERT_BATCH_SIZE,
+            wait=True,
+        )
+
+    async def asearch_batch(
+        self,
+        collection_name: str,
+        query_vectors: List[List[float]],
+        limit: int = 5,
+        payload_fields: Optional[List[str]] = None,
+    ):
+        # SEARCH_BATCH_SIZE queries per round-trip, so large comment files
+        # stay within the request size limits; results come back in query
+        # order. payload_fields limits the payload returned with each hit to
+        # those keys; None returns all of it.
+        logger.info(
+            f"Searching {collection_name} for top {limit} results "
+            f"of {len(query_vectors)} queries"
+        )
+        requests = [
+            SearchRequest(
+                vector=np.asarray(vector, dtype=np.float32).tolist(),
+                limit=limit,
+                with_payload=_payload(payload_fields),
+                params=self.search_params,
+            )
+            for vector in query_vectors
+        ]
+        blocks = await asyncio.gather(
+            *(
+                self.async_client.search_batch(
+                    collection_name=collection_name,
+                    requests=requests[start : start + SEARCH_BATCH_SIZE],
+                )
+                for start in range(0, len(requests), SEARCH_BATCH_SIZE)
+            )
         )
+        return [hits for block in blocks for hits in block]
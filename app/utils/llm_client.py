@@ -1,7 +1,7 @@
+import asyncio
 import logging
-from openai import OpenAI
-import time
-from ..config import settings
+from openai import AsyncOpenAI
+from .. import config
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -9,21 +9,33 @@ logger = logging.getLogger(__name__)
 
 class LLMClient:
     def __init__(self):
-        self.vllm_base_url = f"http://{settings.VLLM_HOST}:{settings.VLLM_PORT}/v1"
+        self.vllm_base_url = config.VLLM_BASE_URL
         logger.info(f"Initializing LLM client with URL: {self.vllm_base_url}")
-        self.client = OpenAI(base_url=self.vllm_base_url, api_key=settings.VLLM_API_KEY)
-
-    def get_completion(self, prompt, max_retries=3):
+        self.async_client = AsyncOpenAI(
+            base_url=self.vllm_base_url, api_key=config.VLLM_API_KEY
+        )
+        self.model = config.VLLM_MODEL
+
+    def _request(self, prompt, system):
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        return {
+            "model": self.model,
+            "messages": messages,
+            "temperature": 0,
+            "max_tokens": 2000,
+        }
+
+    async def aget_completion(self, prompt, max_retries=3, system=None):
+        # Retries with exponential backoff; None once every attempt failed.
         for attempt in range(max_retries + 1):
             try:
                 logger.info(
                     f"Sending prompt to LLM (attempt {attempt + 1}/{max_retries + 1})"
                 )
-                response = self.client.chat.completions.create(
-                    model=settings.VLLM_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0,
-                    max_tokens=2000,
+                response = await self.async_client.chat.completions.create(
+                    **self._request(prompt, system)
                 )
 
                 if response.choices and response.choices[0].message:
@@ -37,7 +49,7 @@ class LLMClient:
             if attempt < max_retries:
                 sleep_time = 2**attempt
                 logger.info(f"Retrying in {sleep_time} seconds...")
-                time.sleep(sleep_time)
+                await asyncio.sleep(sleep_time)
 
         logger.error("All LLM attempts failed")
         return None